@@ -1,5 +1,11 @@
-import os, json, uuid, logging
+import os, uuid, logging, threading, tempfile, time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from flask import Flask, request, abort, jsonify
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from requests_toolbelt import MultipartEncoder
 
 logging.basicConfig(level=logging.INFO)
 app = Flask(__name__)
@@ -15,21 +21,78 @@ CHANNEL_TOKEN = os.environ.get("CHANNEL_TOKEN", "secret-123")
 # Optional: restrict to a single Drive folder (parents contains this ID)
 TARGET_FOLDER_ID = os.environ.get("TARGET_FOLDER_ID", "").strip()
 
+# Changes fetched per changes().list call (Drive allows up to 1000)
+CHANGES_PAGE_SIZE = int(os.environ.get("CHANGES_PAGE_SIZE", "1000"))
+
+# Files downloaded from Drive / uploaded to Dify concurrently
+SYNC_WORKERS = int(os.environ.get("SYNC_WORKERS", "8"))
+
+# Download buffering; the Drive connection pool is sized for SYNC_WORKERS * RANGE_PARTS
+SPOOL_MAX_SIZE = 8 * 1024 * 1024        # files above this spill from RAM to a temp file
+DOWNLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+RANGE_THRESHOLD = 16 * 1024 * 1024      # larger downloads are split into parallel byte ranges
+RANGE_PARTS = 4
+
+# Lifetime requested for Drive watch channels (Drive caps changes channels at 7 days); renew via /renew
+CHANNEL_TTL_SECONDS = int(os.environ.get("CHANNEL_TTL_SECONDS", str(7 * 24 * 3600)))
+
 # ------------------ Lazy clients ------------------
+_clients_lock = threading.Lock()
+_drive = None
+_db = None
+_drive_authed = None
+
 def _clients():
     """
-    Create Google Drive + Firestore clients lazily (so startup never fails).
+    Create Google Drive + Firestore clients lazily (so startup never fails), once per process.
     """
+    global _drive, _db, _drive_authed
+    if _drive is None:
+        with _clients_lock:
+            if _drive is None:
+                _drive, _db, _drive_authed = _build_clients()
+    return _drive, _db
+
+def _drive_session():
+    """
+    Keep-alive requests.Session authorized for Drive, for calls made against the REST API directly.
+    """
+    _clients()
+    return _drive_authed
+
+def _build_clients():
     from google.cloud import firestore
     import google.auth
+    from google.auth.transport.requests import AuthorizedSession
+    import google_auth_httplib2
+    import httplib2
     from googleapiclient.discovery import build
+    from googleapiclient.http import HttpRequest
 
     creds, _ = google.auth.default(scopes=["https://www.googleapis.com/auth/drive.readonly"])
-    drive = build("drive", "v3", credentials=creds, cache_discovery=False)
+
+    # httplib2.Http is not thread-safe: give each thread calling googleapiclient (Flask request threads and
+    # the background sync thread, which runs the metadata batches) its own transport
+    local = threading.local()
+
+    def _request_builder(http, *args, **kwargs):
+        if not hasattr(local, "http"):
+            local.http = google_auth_httplib2.AuthorizedHttp(creds, http=httplib2.Http())
+        return HttpRequest(local.http, *args, **kwargs)
+
+    # Discovery doc bundled with googleapiclient: no fetch at cold start
+    drive = build("drive", "v3", credentials=creds, static_discovery=True, requestBuilder=_request_builder)
     db = firestore.Client()
-    return drive, db
+
+    authed = AuthorizedSession(creds)
+    authed.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=max(32, SYNC_WORKERS * RANGE_PARTS)))
+    # Google APIs only gzip responses when the User-Agent mentions gzip (Accept-Encoding is set by requests)
+    authed.headers["User-Agent"] = "dify-drive-sync (gzip)"
+    return drive, db, authed
 
 # ------------------ Firestore state helpers ------------------
+FIRESTORE_BATCH_LIMIT = 500  # max writes per commit
+
 def _get_state(db):
     doc = db.collection("state").document("drive").get()
     return doc.to_dict() if doc.exists else {}
@@ -37,98 +100,318 @@ def _get_state(db):
 def _set_state(db, payload):
     db.collection("state").document("drive").set(payload, merge=True)
 
-# ------------------ Drive download/export ------------------
-def _export_or_download(drive, file_id: str, mime_type: str, name_hint: str):
-    """
-    Export Google Docs/Sheets/Slides to standard formats, otherwise download as-is.
-    Returns (filename, bytes).
-    """
-    if mime_type.startswith("application/vnd.google-apps"):
-        if mime_type.endswith("document"):
-            out = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
-            filename = f"{(name_hint or file_id)}.docx"
-        elif mime_type.endswith("spreadsheets"):
-            out = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-            filename = f"{(name_hint or file_id)}.xlsx"
+def _commit_state(db, payload=None, fingerprints=None):
+    """
+    Write uploaded-file fingerprints and an optional state update using batched commits (one for most pages).
+    The state update rides in the last commit, so pageToken never advances past unsaved fingerprints.
+    """
+    batch, writes = db.batch(), 0
+    for file_id, fingerprint in (fingerprints or {}).items():
+        if writes == FIRESTORE_BATCH_LIMIT:
+            batch.commit()
+            batch, writes = db.batch(), 0
+        batch.set(_fingerprint_ref(db, file_id), {"fingerprint": fingerprint})
+        writes += 1
+    if payload:
+        if writes == FIRESTORE_BATCH_LIMIT:
+            batch.commit()
+            batch, writes = db.batch(), 0
+        batch.set(db.collection("state").document("drive"), payload, merge=True)
+        writes += 1
+    if writes:
+        batch.commit()
+
+def _fingerprint_ref(db, file_id: str):
+    return db.collection("state").document("drive").collection("fingerprints").document(file_id)
+
+def _get_fingerprints(db, file_ids):
+    """
+    Return {file_id: fingerprint} of the last version uploaded to Dify, in one batched read.
+    """
+    if not file_ids:
+        return {}
+    refs = [_fingerprint_ref(db, fid) for fid in file_ids]
+    return {
+        snap.id: snap.get("fingerprint")
+        for snap in db.get_all(refs, field_paths=["fingerprint"])
+        if snap.exists
+    }
+
+# ------------------ Drive metadata ------------------
+META_FIELDS = "id,name,mimeType,trashed,parents,md5Checksum,size,version"
+# A change's embedded file is complete once these are present; Drive omits empty optional fields
+# (parents, md5Checksum, size), so requiring them would refetch files only to get the same answer
+META_KEYS = ("mimeType", "trashed")
+DRIVE_API = "https://www.googleapis.com/drive/v3"
+DRIVE_BATCH_LIMIT = 100  # Drive rejects batches with more than 100 calls
+
+def _fingerprint(meta):
+    """
+    Content fingerprint used to skip unchanged files: md5Checksum for binary files,
+    version for Google-native files (which have no checksum).
+    """
+    return meta.get("md5Checksum") or meta.get("version")
+
+def _fetch_metadata(drive, file_ids):
+    """
+    Fetch metadata for many files using batched HTTP requests (one round-trip per 100 files).
+    Returns {file_id: meta}.
+    """
+    results, errors = {}, []
+
+    def _collect(request_id, response, exception):
+        if exception is not None:
+            errors.append(exception)
         else:
-            out = "application/pdf"
-            filename = f"{(name_hint or file_id)}.pdf"
-        data = drive.files().export(fileId=file_id, mimeType=out).execute()
-        return filename, data
+            results[request_id] = response
+
+    for i in range(0, len(file_ids), DRIVE_BATCH_LIMIT):
+        batch = drive.new_batch_http_request(callback=_collect)
+        for file_id in file_ids[i:i + DRIVE_BATCH_LIMIT]:
+            batch.add(
+                drive.files().get(fileId=file_id, fields=META_FIELDS, supportsAllDrives=True),
+                request_id=file_id,
+            )
+        batch.execute()
+
+    if errors:
+        raise errors[0]
+    return results
+
+def _list_changes(page_token: str):
+    """
+    One page of changes.list, called through the shared keep-alive session rather than googleapiclient.
+    """
+    r = _drive_session().get(
+        f"{DRIVE_API}/changes",
+        params={
+            "pageToken": page_token,
+            "pageSize": CHANGES_PAGE_SIZE,
+            "includeItemsFromAllDrives": "true",
+            "supportsAllDrives": "true",
+            "includeRemoved": "false",     # removals are never synced; don't page through them
+            "restrictToMyDrive": "false",
+            "spaces": "drive",
+            "fields": f"changes(fileId,removed,file({META_FIELDS})),newStartPageToken,nextPageToken",
+        },
+        timeout=60,
+    )
+    r.raise_for_status()
+    return orjson.loads(r.content)
+
+# ------------------ Drive download/export ------------------
+def _download(url: str, params: dict):
+    """
+    Stream a Drive GET into a spooled temp file, one chunk at a time.
+    Returns the file object, rewound to the start.
+    """
+    fh = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    try:
+        with _drive_session().get(url, params=params, stream=True, timeout=120) as r:
+            r.raise_for_status()
+            for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                fh.write(chunk)
+    except Exception:
+        fh.close()
+        raise
+    fh.seek(0)
+    return fh
+
+def _download_range(url: str, params: dict, fd: int, start: int, end: int, size: int):
+    """
+    Fetch bytes start..end of a Drive file and write them at the same offset of fd.
+    """
+    # identity: byte ranges of a gzip-encoded body can't be decoded independently
+    headers = {"Range": f"bytes={start}-{end}", "Accept-Encoding": "identity"}
+    offset = start
+    with _drive_session().get(url, params=params, headers=headers, stream=True, timeout=120) as r:
+        r.raise_for_status()
+        if r.status_code != 206:
+            raise RuntimeError(f"Drive ignored Range request for {url}")
+        total = r.headers.get("Content-Range", "").rpartition("/")[2]
+        if total != str(size):
+            raise RuntimeError(f"{url} is {total} bytes, expected {size} (changed during download?)")
+        for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            view = memoryview(chunk)
+            while view:
+                written = os.pwrite(fd, view, offset)
+                view = view[written:]
+                offset += written
+    if offset != end + 1:
+        raise RuntimeError(f"Short read for bytes {start}-{end} of {url}")
+
+def _download_ranged(url: str, params: dict, size: int):
+    """
+    Download a large file as RANGE_PARTS parallel byte ranges, each written in place into one temp file.
+    """
+    fh = tempfile.TemporaryFile()
+    try:
+        fh.truncate(size)
+        step = -(-size // RANGE_PARTS)
+        with ThreadPoolExecutor(max_workers=RANGE_PARTS) as pool:
+            futures = [
+                pool.submit(_download_range, url, params, fh.fileno(), start, min(start + step, size) - 1, size)
+                for start in range(0, size, step)
+            ]
+        for future in futures:
+            future.result()
+    except Exception:
+        fh.close()
+        raise
+    fh.seek(0)
+    return fh
+
+GOOGLE_APPS_PREFIX = "application/vnd.google-apps."
+
+# Google-native type -> (export mime type, file extension); other native types (folders, forms, ...) can't be exported
+GOOGLE_EXPORTS = {
+    "application/vnd.google-apps.document": (
+        "application/vnd.openxmlformats-officedocument.wordprocessingml.document", "docx"),
+    "application/vnd.google-apps.spreadsheet": (
+        "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", "xlsx"),
+    "application/vnd.google-apps.presentation": (
+        "application/vnd.openxmlformats-officedocument.presentationml.presentation", "pptx"),
+    "application/vnd.google-apps.drawing": ("application/pdf", "pdf"),
+}
+
+def _export_or_download(file_id: str, mime_type: str, name_hint: str, size=None):
+    """
+    Export Google Docs/Sheets/Slides/Drawings to standard formats, otherwise download as-is.
+    Returns (filename, file object); the caller closes the file.
+    """
+    mapping = GOOGLE_EXPORTS.get(mime_type)
+    if mapping:
+        out, ext = mapping
+        filename = f"{(name_hint or file_id)}.{ext}"
+        fh = _download(f"{DRIVE_API}/files/{file_id}/export", {"mimeType": out})
+        return filename, fh
     else:
-        data = drive.files().get_media(fileId=file_id).execute()
-        meta = drive.files().get(fileId=file_id, fields="name").execute()
-        return meta.get("name", file_id), data
+        url = f"{DRIVE_API}/files/{file_id}"
+        params = {"alt": "media", "supportsAllDrives": "true"}
+        if size and int(size) > RANGE_THRESHOLD:
+            fh = _download_ranged(url, params, int(size))
+        else:
+            fh = _download(url, params)
+        return (name_hint or file_id), fh
 
 # ------------------ Dify upload ------------------
-def _upload_to_dify(filename: str, content_bytes: bytes):
-    import requests
+# One pooled keep-alive session per process, so uploads skip the TCP/TLS handshake
+_dify_session = requests.Session()
+_dify_adapter = HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=max(32, SYNC_WORKERS),
+    max_retries=Retry(total=3, backoff_factor=0.3),  # connection errors only; see _post_document
+)
+_dify_session.mount("https://", _dify_adapter)
+_dify_session.mount("http://", _dify_adapter)  # self-hosted Dify
 
-    if not DIFY_API_KEY or not DIFY_DATASET_ID:
-        raise RuntimeError("Missing DIFY_API_KEY or DIFY_DATASET_ID")
+class _SizedReader:
+    """
+    Read-only view of a downloaded file that reports its remaining length via `len`.
+    MultipartEncoder would otherwise call fileno() to size it, which rolls a SpooledTemporaryFile onto disk.
+    """
+    def __init__(self, fh):
+        fh.seek(0, os.SEEK_END)
+        self._size = fh.tell()
+        fh.seek(0)
+        self._fh = fh
 
-    headers = {"Authorization": f"Bearer {DIFY_API_KEY}"}
+    @property
+    def len(self):
+        return self._size - self._fh.tell()
 
-    # 1) Minimal payload (most robust)
-    files = {
-        "file": (filename, content_bytes, "application/octet-stream"),
-    }
-    r = requests.post(
-        f"{DIFY_API_BASE}/v1/datasets/{DIFY_DATASET_ID}/document/create-by-file",
-        headers=headers,
-        files=files,
-        timeout=120,
-    )
-    if r.status_code == 400:
-        # 2) Retry with light processing options (pass as plain string field, not JSON part)
-        process_opts = {
-            "indexing_technique": "high_quality",
-            # "process_rule": {"rules": {"segmentation": {"max_tokens": 800}}}  # enable later if you want
-        }
-        files = {
-            "file": (filename, content_bytes, "application/octet-stream"),
-            "data": (None, json.dumps(process_opts)),
-        }
-        r = requests.post(
+    def read(self, size=-1):
+        return self._fh.read(size)
+
+DIFY_RETRY_STATUSES = {429, 500, 502, 503, 504}
+DIFY_MAX_ATTEMPTS = 4
+
+def _post_document(filename: str, fh, data):
+    """
+    Stream one file to Dify's create-by-file endpoint as multipart.
+    Retries 429/5xx here rather than in the adapter: a streamed body has to be rewound before it can be resent.
+    """
+    for attempt in range(DIFY_MAX_ATTEMPTS):
+        encoder = MultipartEncoder(
+            fields={"file": (filename, _SizedReader(fh), "application/octet-stream"), "data": data}
+        )
+        r = _dify_session.post(
             f"{DIFY_API_BASE}/v1/datasets/{DIFY_DATASET_ID}/document/create-by-file",
-            headers=headers,
-            files=files,
+            headers={"Authorization": f"Bearer {DIFY_API_KEY}", "Content-Type": encoder.content_type},
+            data=encoder,
             timeout=120,
         )
+        if r.status_code not in DIFY_RETRY_STATUSES or attempt == DIFY_MAX_ATTEMPTS - 1:
+            return r
+        time.sleep(0.3 * (2 ** attempt))
+
+def _upload_to_dify(filename: str, fh):
+    if not DIFY_API_KEY or not DIFY_DATASET_ID:
+        raise RuntimeError("Missing DIFY_API_KEY or DIFY_DATASET_ID")
+
+    # Processing options go in a plain string field, not a JSON part
+    process_opts = {
+        "indexing_technique": "high_quality",
+        # "process_rule": {"rules": {"segmentation": {"max_tokens": 800}}}  # enable later if you want
+    }
+    r = _post_document(filename, fh, data=(None, orjson.dumps(process_opts)))
 
     try:
         r.raise_for_status()
     except Exception:
         app.logger.error("Dify upload failed: %s %s", r.status_code, r.text[:1000])
         raise
-    return r.json()
+    return orjson.loads(r.content)
 
 # ------------------ Process changes ------------------
-def _process_changes(drive, db, page_token: str):
+# Long-lived, so worker threads aren't respawned for every page; the connections they use come from the
+# shared Drive (AuthorizedSession) and Dify requests pools, which outlive any thread
+_sync_pool = ThreadPoolExecutor(max_workers=SYNC_WORKERS, thread_name_prefix="sync")
+
+def _sync_file(meta):
     """
-    Pull changes from Drive, optionally filter by TARGET_FOLDER_ID, upload to Dify, then advance pageToken.
+    Download/export one Drive file and upload it to Dify.
     """
-    result = drive.changes().list(
-        pageToken=page_token,
-        includeItemsFromAllDrives=True,
-        supportsAllDrives=True
-    ).execute()
+    file_id = meta["id"]
+    fname, fh = _export_or_download(file_id, meta.get("mimeType"), meta.get("name"), meta.get("size"))
+    with fh:
+        app.logger.info("Uploading to Dify: %s (id=%s)", fname, file_id)
+        _upload_to_dify(fname, fh)
 
-    for ch in result.get("changes", []):
-        if ch.get("removed"):
-            continue
+def _sync_changes(drive, db, changes):
+    """
+    Upload the files referenced by one page of changes, optionally filtered by TARGET_FOLDER_ID.
+    Returns {file_id: fingerprint} for the uploaded files, for the caller to persist.
+    """
+    # Drive often reports several edits of one file per page; only the last one matters
+    latest = {}
+    for ch in changes:
         file = ch.get("file") or {}
-        file_id = file.get("id")
-        if not file_id:
+        file_id = ch.get("fileId") or file.get("id")
+        if file_id:
+            latest[file_id] = ch
+
+    files = []
+    for file_id, ch in latest.items():
+        if ch.get("removed"):
             continue
+        files.append({"id": file_id, **(ch.get("file") or {})})
+
+    # Only look up files whose metadata didn't come back with the change itself
+    missing = [f["id"] for f in files if not all(k in f for k in META_KEYS)]
+    fetched = _fetch_metadata(drive, missing) if missing else {}
 
-        meta = drive.files().get(
-            fileId=file_id,
-            fields="id,name,mimeType,trashed,parents"
-        ).execute()
+    to_sync = []
+    for file in files:
+        meta = fetched.get(file["id"], file)
         if meta.get("trashed"):
             continue
 
+        mime = meta.get("mimeType") or ""
+        if mime.startswith(GOOGLE_APPS_PREFIX) and mime not in GOOGLE_EXPORTS:
+            app.logger.info("Skipping %s (%s can't be exported)", meta.get("name"), mime)
+            continue
+
         # Optional: filter to one folder
         if TARGET_FOLDER_ID:
             parents = set(meta.get("parents") or [])
@@ -136,16 +419,139 @@ def _process_changes(drive, db, page_token: str):
                 app.logger.info("Skipping %s (outside target folder)", meta.get("name"))
                 continue
 
-        name = meta.get("name")
-        mime = meta.get("mimeType")
+        to_sync.append(meta)
 
-        fname, bytes_ = _export_or_download(drive, file_id, mime, name)
-        app.logger.info("Uploading to Dify: %s (id=%s)", fname, file_id)
-        _upload_to_dify(fname, bytes_)
+    # Skip files whose content is unchanged since the last upload
+    stored = _get_fingerprints(db, [m["id"] for m in to_sync if _fingerprint(m)])
+    to_sync = [m for m in to_sync if not _fingerprint(m) or stored.get(m["id"]) != _fingerprint(m)]
+
+    fingerprints, failed = {}, 0
+    futures = {_sync_pool.submit(_sync_file, meta): meta for meta in to_sync}
+    for future in as_completed(futures):
+        meta = futures[future]
+        try:
+            future.result()
+        except Exception:
+            app.logger.exception("Sync failed for %s (id=%s)", meta.get("name"), meta["id"])
+            failed += 1
+        else:
+            if _fingerprint(meta):
+                fingerprints[meta["id"]] = _fingerprint(meta)
+
+    # Fail the page so its pageToken is not advanced and the changes are retried;
+    # keep the fingerprints of what did upload so the retry skips those files
+    if failed:
+        _commit_state(db, fingerprints=fingerprints)
+        raise RuntimeError(f"{failed} of {len(to_sync)} file(s) failed to sync")
+    return fingerprints
+
+def _process_changes(drive, db, page_token: str):
+    """
+    Pull every pending page of changes from Drive and sync it to Dify.
+    pageToken is persisted after each page, so a timeout never replays finished pages.
+    """
+    while True:
+        result = _list_changes(page_token)
+
+        fingerprints = _sync_changes(drive, db, result.get("changes", []))
+
+        next_token = result.get("nextPageToken")
+        if next_token:
+            _commit_state(db, {"pageToken": next_token}, fingerprints)
+            page_token = next_token
+            continue
+
+        new_token = result.get("newStartPageToken")
+        _commit_state(db, {"pageToken": new_token} if new_token else None, fingerprints)
+        break
+
+# ------------------ Background sync ------------------
+# Needs CPU outside requests on Cloud Run (--no-cpu-throttling, ideally min-instances >= 1).
+_sync_lock = threading.Lock()
+_sync_status = {"running": False, "pending": False}
+
+def _schedule_sync():
+    """
+    Run _process_changes on a background thread.
+    Notifications that arrive while a sync is running are coalesced into a single follow-up pass.
+    """
+    with _sync_lock:
+        if _sync_status["running"]:
+            _sync_status["pending"] = True
+            return
+        _sync_status["running"] = True
+    threading.Thread(target=_sync_worker, daemon=True).start()
+
+def _claim_sync():
+    """
+    Take the sync guard for work that moves pageToken outside the background thread (/debug/pull, /init).
+    Returns False if a sync is already running.
+    """
+    with _sync_lock:
+        if _sync_status["running"]:
+            return False
+        _sync_status["running"] = True
+        return True
+
+def _release_sync():
+    """
+    Release the sync guard; if notifications arrived meanwhile, hand it to a background follow-up pass instead.
+    """
+    with _sync_lock:
+        if not _sync_status["pending"]:
+            _sync_status["running"] = False
+            return
+        _sync_status["pending"] = False
+    threading.Thread(target=_sync_worker, daemon=True).start()
+
+def _sync_worker():
+    try:
+        drive, db = _clients()
+        page_token = _get_state(db).get("pageToken")
+        if page_token:
+            _process_changes(drive, db, page_token)
+        else:
+            app.logger.error("Missing pageToken; open /init once.")
+    except Exception:
+        app.logger.exception("background sync failed")
+    finally:
+        _release_sync()
 
-    new_token = result.get("newStartPageToken") or result.get("nextPageToken")
-    if new_token:
-        _set_state(db, {"pageToken": new_token})
+# ------------------ Drive watch channel ------------------
+def _start_watch(drive, page_token: str):
+    """
+    Open a changes.watch channel that notifies /drive-webhook.
+    Returns the channel fields to store in the state doc.
+    """
+    body = {
+        "id": str(uuid.uuid4()),
+        "type": "web_hook",
+        "address": WEBHOOK_URL.rstrip("/") + "/drive-webhook",
+        "token": CHANNEL_TOKEN,
+        "expiration": int((time.time() + CHANNEL_TTL_SECONDS) * 1000),
+    }
+    channel = drive.changes().watch(
+        pageToken=page_token,
+        supportsAllDrives=True,
+        includeItemsFromAllDrives=True,
+        body=body,
+        fields="id,resourceId,expiration",
+    ).execute()
+    return {
+        "channelId": channel["id"],
+        "resourceId": channel["resourceId"],
+        "channelExpiration": channel.get("expiration"),
+    }
+
+def _stop_watch(drive, state):
+    """
+    Best-effort stop of the channel recorded in `state` (it expires on its own if this fails).
+    """
+    if state.get("channelId") and state.get("resourceId"):
+        try:
+            drive.channels().stop(body={"id": state["channelId"], "resourceId": state["resourceId"]}).execute()
+        except Exception:
+            app.logger.warning("could not stop old channel %s", state["channelId"], exc_info=True)
 
 # ------------------ Routes ------------------
 @app.get("/")
@@ -166,6 +572,7 @@ def debug_info():
         drive, db = _clients()
         state = _get_state(db)
         info["stored_page_token"] = state.get("pageToken")
+        info["channel_expiration"] = state.get("channelExpiration")
         return jsonify(info)
     except Exception as e:
         app.logger.exception("debug_info failed")
@@ -174,6 +581,8 @@ def debug_info():
 
 @app.post("/debug/pull")
 def debug_pull():
+    if not _claim_sync():
+        return jsonify({"ok": False, "error": "a sync is already running"}), 409
     try:
         drive, db = _clients()
         state = _get_state(db)
@@ -185,49 +594,63 @@ def debug_pull():
     except Exception as e:
         app.logger.exception("manual pull failed")
         return jsonify({"ok": False, "error": str(e)}), 500
+    finally:
+        _release_sync()
 
 @app.get("/init")
 def init_watch():
+    # A running sync would overwrite the fresh start token with its own nextPageToken
+    if not _claim_sync():
+        return jsonify({"ok": False, "error": "a sync is running; retry /init when it finishes"}), 409
     try:
         if not WEBHOOK_URL or not WEBHOOK_URL.startswith("https://"):
             raise RuntimeError("WEBHOOK_URL missing or invalid (must be https Cloud Run URL)")
         drive, db = _clients()
-        token = drive.changes().getStartPageToken().execute()["startPageToken"]
-        _set_state(db, {"pageToken": token})
-
-        channel_id = str(uuid.uuid4())
-        body = {
-            "id": channel_id,
-            "type": "web_hook",
-            "address": WEBHOOK_URL.rstrip("/") + "/drive-webhook",
-            "token": CHANNEL_TOKEN,
-        }
-        drive.changes().watch(
-            pageToken=token,
-            supportsAllDrives=True,
-            includeItemsFromAllDrives=True,
-            body=body
-        ).execute()
-
-        return jsonify({"ok": True, "channel_id": channel_id, "startPageToken": token})
+        state = _get_state(db)
+        token = drive.changes().getStartPageToken(fields="startPageToken").execute()["startPageToken"]
+
+        # Open the channel first so a failed watch leaves the stored token and channel untouched
+        channel = _start_watch(drive, token)
+        _set_state(db, {"pageToken": token, **channel})
+        _stop_watch(drive, state)
+
+        return jsonify({"ok": True, "channel_id": channel["channelId"], "startPageToken": token})
     except Exception as e:
         app.logger.exception("/init failed")
         return jsonify({"ok": False, "error": str(e)}), 500
+    finally:
+        _release_sync()
 
-@app.post("/drive-webhook")
-def drive_webhook():
+@app.post("/renew")
+def renew_watch():
+    """
+    Replace the watch channel before it expires (call from Cloud Scheduler, e.g. every 6 days).
+    Keeps the stored pageToken, so no changes are missed or replayed.
+    """
     try:
-        app.logger.info("drive-webhook called")
-        if request.headers.get("X-Goog-Channel-Token") != CHANNEL_TOKEN:
-            app.logger.warning("channel token mismatch")
-            abort(403)
+        if not WEBHOOK_URL or not WEBHOOK_URL.startswith("https://"):
+            raise RuntimeError("WEBHOOK_URL missing or invalid (must be https Cloud Run URL)")
         drive, db = _clients()
         state = _get_state(db)
-        page_token = state.get("pageToken")
-        if not page_token:
-            abort(500, "Missing pageToken; open /init once.")
-        _process_changes(drive, db, page_token)
-        return ("", 204)
+        pt = state.get("pageToken")
+        if not pt:
+            return jsonify({"ok": False, "error": "no pageToken; call /init first"}), 400
+
+        channel = _start_watch(drive, pt)
+        _set_state(db, channel)
+        _stop_watch(drive, state)
+
+        return jsonify({"ok": True, "channel_id": channel["channelId"], "expiration": channel["channelExpiration"]})
     except Exception as e:
-        app.logger.exception("/drive-webhook failed")
+        app.logger.exception("/renew failed")
         return jsonify({"ok": False, "error": str(e)}), 500
+
+@app.post("/drive-webhook")
+def drive_webhook():
+    app.logger.info("drive-webhook called")
+    if request.headers.get("X-Goog-Channel-Token") != CHANNEL_TOKEN:
+        app.logger.warning("channel token mismatch")
+        abort(403)
+    # ACK right away: Google retries slow notifications, which would re-upload everything
+    _schedule_sync()
+    return ("", 204)